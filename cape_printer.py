@@ -5,45 +5,167 @@ Automates submission, monitoring, and retrieval of malware analysis results
 """
 
 import os
+import re
+import sys
 import time
+import uuid
+import errno
+import queue
+import atexit
 import json
 import shutil
+import functools
+import sqlite3
 import requests
 import subprocess
 import threading
 from pathlib import Path
+from collections import deque
 from datetime import datetime
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Set
+from typing import Deque, Dict, List, Optional, Set
 from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+import gzip
 import logging
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import ijson  # Optional: streams large reports when extracting selected keys
+except ImportError:
+    ijson = None
+
+try:
+    import watchfiles  # Optional: inotify-driven report detection
+except ImportError:
+    watchfiles = None
+
+try:
+    import orjson  # Optional: faster JSON parsing of API responses
+except ImportError:
+    orjson = None
+
+# Configure logging: records are queued and written by a background listener
+# thread so file/console I/O never runs inside the monitor loop
+_log_queue = queue.Queue(-1)
+_log_listener = QueueListener(
+    _log_queue,
+    logging.FileHandler('cape_automation.log'),
+    logging.StreamHandler(),
+    respect_handler_level=True
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
-# Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('cape_automation.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
-@dataclass
+def _loads(data: bytes):
+    """Parse JSON bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _dumps(obj) -> bytes:
+    """Serialize to compact newline-terminated JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, separators=(',', ':')) + '\n').encode()
+
+def _never_connected(exc: Exception) -> bool:
+    """True if a requests error happened before any connection to the server was made"""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = exc.args[0] if exc.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+# Matches the task ID in utils/submit.py output
+_TASK_ID_RE = re.compile(r'added as task with ID\s+(\d+)')
+
+def _sendfile_copy(src: Path, dst: Path):
+    """Copy a file in-kernel with os.sendfile, preserving metadata like copy2"""
+    in_fd = os.open(src, os.O_RDONLY)
+    try:
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = os.fstat(in_fd).st_size
+            # Reports are read once front to back; ask for aggressive readahead
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(in_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            # Drop the copied pages so large reports don't evict CAPE's working set
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(in_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.posix_fadvise(out_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(out_fd)
+    finally:
+        os.close(in_fd)
+    shutil.copystat(src, dst)
+
+def _move_file(src: Path, dst: Path):
+    """Rename within a filesystem, falling back to shutil.move across devices"""
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(str(src), str(dst))
+
+@dataclass(slots=True)
 class TaskInfo:
     task_id: str
     sample_path: Path
     vm_name: str
     submission_time: float
     status: str = "submitted"
+    completion_time: Optional[float] = None
 
 class CAPEAutomation:
-    def __init__(self, base_dir: str = "/home/cape/Documents", folder_prefixes=None):
+    # Task statuses that keep a VM occupied
+    BUSY_STATUSES = ('submitted', 'pending', 'running')
+
+    def __init__(self, base_dir: str = "/home/cape/Documents", folder_prefixes=None,
+                 report_keys=None, compress_reports: bool = False):
         self.base_dir = Path(base_dir)
         self.cape_dir = Path("/opt/CAPEv2")
         self.cape_storage = Path("/opt/CAPEv2/storage/analyses")
         self.cape_api = "http://127.0.0.1:8000/apiv2"
         
+        # Shared HTTP session so status polls reuse keep-alive connections
+        self.http = requests.Session()
+        self.http.headers.update({"Connection": "keep-alive"})
+        self.http.mount("http://", HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            max_retries=Retry(total=2, backoff_factor=0.2)
+        ))
+        
+        # Fallback CLI submission: argv prefix and subprocess options built once
+        self._base_cmd = ["poetry", "run", "python3", "utils/submit.py", "--route", "inetsim"]
+        self._run_submit = functools.partial(
+            subprocess.run,
+            capture_output=True,
+            text=True,
+            cwd=str(self.cape_dir),
+            stdin=subprocess.DEVNULL,
+            close_fds=not sys.platform.startswith('linux'),  # Skip Popen's fd-closing pass on Linux
+            timeout=30
+        )
+        
         # Default to common malware types, or use provided prefixes
         if folder_prefixes is None:
             self.folder_prefixes = ["Infostealer", "Adware", "Banker", "Downloader","RAT","Ransomware","DDoS","Miner","Benign"]
@@ -51,16 +173,31 @@ class CAPEAutomation:
             self.folder_prefixes = [folder_prefixes]  # Single prefix as string
         else:
             self.folder_prefixes = folder_prefixes  # List of prefixes
+        self._prefix_set = {p.lower() for p in self.folder_prefixes}
+        
+        # Report extraction: keep only these top-level keys (None keeps the full report)
+        self.report_keys: Optional[Set[str]] = set(report_keys) if report_keys else None
+        self.compress_reports = compress_reports  # gzip extracted reports
         
         # VM configuration
         self.vms = ["HEY", "HEY_2", "HEY_3"]
         self.vm_status = {vm: "idle" for vm in self.vms}
+        self._vm_busy: Dict[str, int] = {vm: 0 for vm in self.vms}  # Our in-flight tasks per VM
+        self._vm_status_cache = (0.0, {})  # (monotonic timestamp, status)
         
         # Task tracking with thread safety
         self.active_tasks: Dict[str, TaskInfo] = {}
-        self.completed_tasks: List[TaskInfo] = []
-        self.failed_tasks: List[TaskInfo] = []
-        self.lock = threading.RLock()  # Reentrant lock for nested operations
+        self._completed_count = 0
+        self._failed_count = 0
+        # Guards multi-step mutations of task state only; single dict reads go lock-free
+        self._mutate = threading.Lock()
+        self._finalizing: Set[str] = set()  # Task IDs queued on io_pool
+        self._wake = threading.Event()  # Interrupts the main loop's backoff sleep
+        self._reports_seen: Set[str] = set()  # Tasks whose report.json exists but aren't finalized yet
+        self._watch_stop = threading.Event()  # Stops the report watcher thread
+        
+        # Worker pool for report retrieval and sample moves
+        self.io_pool = ThreadPoolExecutor(max_workers=len(self.vms) + 2)
         
         # Current folder being processed
         self.current_folder = None
@@ -68,6 +205,18 @@ class CAPEAutomation:
         self.json_dir = None
         self.failed_dir = None
         
+        # Finished tasks are persisted here instead of kept in memory
+        self.run_id = uuid.uuid4().hex
+        self._db_lock = threading.Lock()  # Serializes use of the shared connection
+        self.results_db = sqlite3.connect('cape_results.db', isolation_level=None, check_same_thread=False)
+        self.results_db.execute("PRAGMA journal_mode=WAL")
+        self.results_db.execute("PRAGMA synchronous=NORMAL")
+        self.results_db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "run_id TEXT, folder TEXT, task_id TEXT, sample TEXT, vm TEXT, "
+            "submit_ts REAL, complete_ts REAL, status TEXT)"
+        )
+        
         logger.info(f"CAPEv2 Automation initialized - Base dir: {self.base_dir}")
         logger.info(f"VMs available: {', '.join(self.vms)}")
 
@@ -80,15 +229,15 @@ class CAPEAutomation:
         
         logger.info(f"Looking for folders with prefixes: {self.folder_prefixes}")
         
-        for item in self.base_dir.iterdir():
-            if item.is_dir() and '_' in item.name:
-                # Check if it matches any of the specified prefixes with pattern like Prefix_1, Prefix_2, etc.
-                parts = item.name.split('_')
-                if len(parts) == 2 and parts[1].isdigit():
-                    prefix = parts[0]
-                    # Check if this prefix matches any of our target prefixes (case insensitive)
-                    if any(prefix.lower() == target_prefix.lower() for target_prefix in self.folder_prefixes):
-                        folders.append(item)
+        with os.scandir(self.base_dir) as it:
+            for entry in it:
+                if '_' in entry.name and entry.is_dir():
+                    # Check if it matches any of the specified prefixes with pattern like Prefix_1, Prefix_2, etc.
+                    parts = entry.name.split('_')
+                    if len(parts) == 2 and parts[1].isdigit():
+                        # Check if this prefix matches any of our target prefixes (case insensitive)
+                        if parts[0].lower() in self._prefix_set:
+                            folders.append(Path(entry.path))
         
         folders.sort()
         logger.info(f"Discovered folders: {[f.name for f in folders]}")
@@ -111,86 +260,122 @@ class CAPEAutomation:
         if not folder_path.exists():
             return []
         
-        samples = [f for f in folder_path.iterdir() if f.suffix.lower() == '.exe' and f.is_file()]
+        with os.scandir(folder_path) as it:
+            samples = [Path(e.path) for e in it if e.name.lower().endswith('.exe') and e.is_file(follow_symlinks=False)]
         logger.info(f"Found {len(samples)} samples in {folder_path.name}")
         return sorted(samples)
 
-    def get_vm_status(self) -> Dict[str, str]:
-        """Get current status of all VMs via API"""
+    def _poll_all(self) -> Optional[Dict[str, dict]]:
+        """Fetch all tasks in a single API call, indexed by task ID"""
         try:
-            response = requests.get(f"{self.cape_api}/tasks/list/", timeout=10)
+            response = self.http.get(f"{self.cape_api}/tasks/list/", timeout=(2, 10))
             if response.status_code != 200:
-                logger.warning(f"Failed to get VM status: HTTP {response.status_code}")
-                return self.vm_status
-            
-            data = response.json()
-            tasks = data.get('data', [])
-            
-            # Reset VM status
-            vm_status = {vm: "idle" for vm in self.vms}
-            
-            # Check which VMs are busy (only pending and running tasks occupy VMs)
-            for task in tasks:
-                if task.get('status') in ['pending', 'running']:
-                    machine = task.get('machine')
-                    if machine in self.vms:
-                        vm_status[machine] = "busy"
+                logger.warning(f"Failed to list tasks: HTTP {response.status_code}")
+                return None
             
-            return vm_status
+            data = _loads(response.content)
+            if data.get('error'):
+                logger.warning(f"Failed to list tasks: {data.get('error_value')}")
+                return None
+            return {str(task.get('id')): task for task in data.get('data') or []}
             
         except Exception as e:
-            logger.warning(f"Error getting VM status: {e}")
+            logger.warning(f"Error listing tasks: {e}")
+            return None
+
+    def _compute_vm_status(self, tasks_payload) -> Dict[str, str]:
+        """Derive VM status from a list of task entries"""
+        # Reset VM status
+        vm_status = {vm: "idle" for vm in self.vms}
+        
+        # Check which VMs are busy (only pending and running tasks occupy VMs)
+        for task in tasks_payload:
+            if task.get('status') in ['pending', 'running']:
+                machine = task.get('machine')
+                if machine in self.vms:
+                    vm_status[machine] = "busy"
+        
+        return vm_status
+
+    def get_vm_status(self) -> Dict[str, str]:
+        """Get current status of all VMs via API (cached for up to 1 second)"""
+        cached_at, cached_status = self._vm_status_cache
+        if time.monotonic() - cached_at < 1.0:
+            return cached_status
+        
+        tasks = self._poll_all()
+        if tasks is None:
             return self.vm_status
+        
+        vm_status = self._compute_vm_status(tasks.values())
+        self._vm_status_cache = (time.monotonic(), vm_status)
+        return vm_status
 
     def get_available_vm(self) -> Optional[str]:
         """Get an available VM name"""
         vm_status = self.get_vm_status()
         
-        with self.lock:
-            for vm_name in self.vms:
-                if vm_status.get(vm_name) == "idle":
-                    # Check if this VM has any tasks in pending/running status
-                    vm_busy = any(
-                        task.vm_name == vm_name and task.status in ['submitted', 'pending', 'running']
-                        for task in self.active_tasks.values()
-                    )
-                    if not vm_busy:
-                        return vm_name
+        for vm_name in self.vms:
+            # Skip VMs that still have a submitted/pending/running task of ours
+            if vm_status.get(vm_name) == "idle" and self._vm_busy[vm_name] <= 0:
+                return vm_name
         return None
 
     def submit_sample(self, sample_path: Path, vm_name: Optional[str] = None) -> Optional[str]:
-        """Submit a sample to CAPEv2"""
-        cmd = [
-            "poetry", "run", "python3", "utils/submit.py",
-            str(sample_path),
-            "--route", "inetsim"
-        ]
+        """Submit a sample to CAPEv2 via the REST API, falling back to utils/submit.py"""
+        try:
+            with open(sample_path, 'rb') as f:
+                response = self.http.post(
+                    f"{self.cape_api}/tasks/create/file/",
+                    files={'file': (sample_path.name, f)},
+                    data={'route': 'inetsim', 'machine': vm_name or ''},
+                    timeout=(5, 30)
+                )
+        except requests.ConnectionError as e:
+            if _never_connected(e):
+                logger.warning(f"API submission unavailable for {sample_path.name}, using CLI: {e}")
+                return self._submit_sample_cli(sample_path, vm_name)
+            # Aborted mid-request: CAPE may already have created the task, so don't resubmit
+            logger.error(f"Submission connection lost for {sample_path.name}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"Submission error for {sample_path.name}: {e}")
+            return None
         
-        if vm_name:
-            cmd.extend(["--machine", vm_name])
+        if not response.ok:
+            logger.warning(f"API submission failed for {sample_path.name}: HTTP {response.status_code}, using CLI")
+            return self._submit_sample_cli(sample_path, vm_name)
         
         try:
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                cwd=str(self.cape_dir), 
-                timeout=30
-            )
+            data = _loads(response.content)
+            if data.get('error'):
+                logger.error(f"Submission failed for {sample_path.name}: {data.get('error_value')}")
+                return None
+            task_id = str(data['data']['task_ids'][0])
+        except Exception as e:
+            logger.error(f"Could not extract task ID for {sample_path.name}: {e}")
+            return None
+        
+        logger.info(f"Submitted {sample_path.name} as task {task_id} on {vm_name or 'any VM'}")
+        return task_id
+
+    def _submit_sample_cli(self, sample_path: Path, vm_name: Optional[str] = None) -> Optional[str]:
+        """Submit a sample to CAPEv2 through utils/submit.py"""
+        cmd = self._base_cmd + [str(sample_path)] + (["--machine", vm_name] if vm_name else [])
+        
+        try:
+            result = self._run_submit(cmd)
             
             if result.returncode != 0:
                 logger.error(f"Submission failed for {sample_path.name}: {result.stderr.strip()}")
                 return None
             
             # Extract task ID from output
-            for line in result.stdout.splitlines():
-                if "added as task with ID" in line:
-                    import re
-                    task_ids = re.findall(r'\d+', line)
-                    if task_ids:
-                        task_id = task_ids[-1]
-                        logger.info(f"Submitted {sample_path.name} as task {task_id} on {vm_name or 'any VM'}")
-                        return task_id
+            m = _TASK_ID_RE.search(result.stdout)
+            if m:
+                task_id = m.group(1)
+                logger.info(f"Submitted {sample_path.name} as task {task_id} on {vm_name or 'any VM'}")
+                return task_id
             
             logger.error(f"Could not extract task ID for {sample_path.name}")
             return None
@@ -205,9 +390,9 @@ class CAPEAutomation:
     def get_task_status(self, task_id: str) -> Optional[str]:
         """Get status of a specific task"""
         try:
-            response = requests.get(f"{self.cape_api}/tasks/view/{task_id}/", timeout=10)
+            response = self.http.get(f"{self.cape_api}/tasks/view/{task_id}/", timeout=(2, 10))
             if response.status_code == 200:
-                data = response.json()
+                data = _loads(response.content)
                 status = data.get('data', {}).get('status', 'unknown')
                 return status
             else:
@@ -217,7 +402,7 @@ class CAPEAutomation:
             logger.warning(f"Error getting task {task_id} status: {e}")
             return None
 
-    def retrieve_json_report(self, task_id: str, sample_name: str) -> bool:
+    def retrieve_json_report(self, task_id: str, sample_name: str, timestamp: Optional[str] = None) -> bool:
         """Retrieve and save JSON report for completed task"""
         report_path = self.cape_storage / task_id / "reports" / "report.json"
         
@@ -226,10 +411,27 @@ class CAPEAutomation:
             return False
         
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            if timestamp is None:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             dest_path = self.json_dir / f"task_{task_id}_{sample_name}_{timestamp}.json"
             
-            shutil.copy2(report_path, dest_path)
+            if self.report_keys is not None:
+                dest_path = self._extract_report(report_path, dest_path)
+                logger.info(f"Extracted JSON report for task {task_id}: {dest_path}")
+                self.delete_pcap(task_id)
+                return True
+            
+            # Hardlink when on the same filesystem (no bytes copied)
+            try:
+                os.link(report_path, dest_path)
+            except FileExistsError:
+                dest_path = dest_path.with_name(f"{dest_path.stem}_{uuid.uuid4().hex[:8]}{dest_path.suffix}")
+                os.link(report_path, dest_path)
+            except OSError as e:
+                # Cross-device or hardlinks not permitted: copy in-kernel instead
+                if e.errno not in (errno.EXDEV, errno.EPERM):
+                    raise
+                _sendfile_copy(report_path, dest_path)
             logger.info(f"Retrieved JSON report for task {task_id}: {dest_path}")
             
             # Delete PCAP file to save space
@@ -240,6 +442,23 @@ class CAPEAutomation:
             logger.error(f"Failed to retrieve report for task {task_id}: {e}")
             return False
 
+    def _extract_report(self, report_path: Path, dest_path: Path) -> Path:
+        """Write only the configured top-level keys of a report, returns the written path"""
+        with open(report_path, 'rb') as f:
+            if ijson is not None:
+                selected = {k: v for k, v in ijson.kvitems(f, '', use_float=True) if k in self.report_keys}
+            else:
+                selected = {k: v for k, v in json.load(f).items() if k in self.report_keys}
+        
+        if self.compress_reports:
+            dest_path = dest_path.with_name(dest_path.name + '.gz')
+            with gzip.open(dest_path, 'wb') as out:
+                out.write(_dumps(selected))
+        else:
+            with open(dest_path, 'wb') as out:
+                out.write(_dumps(selected))
+        return dest_path
+
     def delete_pcap(self, task_id: str):
         """Delete PCAP file to save disk space"""
         pcap_path = self.cape_storage / task_id / "dump.pcap"
@@ -250,14 +469,15 @@ class CAPEAutomation:
             except Exception as e:
                 logger.warning(f"Failed to delete PCAP for task {task_id}: {e}")
 
-    def move_processed_sample(self, sample_path: Path, task_id: str):
+    def move_processed_sample(self, sample_path: Path, task_id: str, timestamp: Optional[str] = None):
         """Move processed sample to processed directory"""
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            if timestamp is None:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             dest_path = self.processed_dir / f"task_{task_id}_{sample_path.name}_{timestamp}"
             
             if sample_path.exists():
-                shutil.move(str(sample_path), str(dest_path))
+                _move_file(sample_path, dest_path)
                 logger.info(f"Moved processed sample: {sample_path.name} -> {dest_path}")
             else:
                 logger.warning(f"Sample {sample_path.name} no longer exists")
@@ -265,14 +485,15 @@ class CAPEAutomation:
         except Exception as e:
             logger.error(f"Failed to move processed sample {sample_path.name}: {e}")
 
-    def move_failed_sample(self, sample_path: Path, reason: str):
+    def move_failed_sample(self, sample_path: Path, reason: str, timestamp: Optional[str] = None):
         """Move failed sample to failed directory"""
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            if timestamp is None:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             dest_path = self.failed_dir / f"failed_{reason}_{sample_path.name}_{timestamp}"
             
             if sample_path.exists():
-                shutil.move(str(sample_path), str(dest_path))
+                _move_file(sample_path, dest_path)
                 logger.warning(f"Moved failed sample: {sample_path.name} -> {dest_path} (reason: {reason})")
             else:
                 logger.warning(f"Failed sample {sample_path.name} no longer exists")
@@ -280,55 +501,160 @@ class CAPEAutomation:
         except Exception as e:
             logger.error(f"Failed to move failed sample {sample_path.name}: {e}")
 
-    def monitor_tasks(self):
-        """Monitor active tasks and update their status"""
-        with self.lock:
-            tasks_to_remove = []
-            
-            for task_id, task_info in self.active_tasks.items():
+    def _finalize_reported(self, task_info: TaskInfo, timestamp: Optional[str] = None):
+        """Retrieve the report / move the sample for a finished task (runs on io_pool)"""
+        task_id = task_info.task_id
+        try:
+            if task_info.status == "reported":
+                # JSON report is ready for retrieval
+                success = self.retrieve_json_report(task_id, task_info.sample_path.name, timestamp)
+                if success:
+                    result_status = "completed"
+                    self.move_processed_sample(task_info.sample_path, task_id, timestamp)
+                    logger.info(f"✅ Retrieved and processed task {task_id}: {task_info.sample_path.name}")
+                else:
+                    result_status = "report_retrieval_failed"
+                    self.move_failed_sample(task_info.sample_path, result_status, timestamp)
+                    logger.error(f"✗ Failed to retrieve report for task {task_id}")
+            else:
+                # Task failed
+                success = False
+                result_status = task_info.status
+                self.move_failed_sample(task_info.sample_path, task_info.status, timestamp)
+                logger.warning(f"✗ Failed task {task_id}: {task_info.sample_path.name} ({task_info.status})")
+        except Exception as e:
+            success = False
+            result_status = "finalize_error"
+            logger.error(f"Error finalizing task {task_id}: {e}")
+        
+        self.record_result(task_info, result_status)
+        with self._mutate:
+            if success:
+                self._completed_count += 1
+            else:
+                self._failed_count += 1
+            self.active_tasks.pop(task_id, None)
+            self._finalizing.discard(task_id)
+
+    def record_result(self, task_info: TaskInfo, status: str):
+        """Persist a finished task to the results database"""
+        try:
+            with self._db_lock:
+                self.results_db.execute(
+                    "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self.run_id, self.current_folder, task_info.task_id, task_info.sample_path.name,
+                     task_info.vm_name, task_info.submission_time, task_info.completion_time, status)
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to record result for task {task_info.task_id}: {e}")
+
+    def _apply_status(self, task_info: TaskInfo, current_status: str):
+        """Record a new status for an active task (caller holds self._mutate).
+        
+        Returns (changed, finished); finished tasks are marked for finalization.
+        """
+        task_id = task_info.task_id
+        previous_status = task_info.status
+        task_info.status = current_status
+        
+        changed = current_status != previous_status
+        if changed:
+            logger.info(f"Task {task_id} status changed: {previous_status} -> {current_status}")
+            # Task occupies its VM only while submitted/pending/running
+            was_busy = previous_status in self.BUSY_STATUSES
+            is_busy = current_status in self.BUSY_STATUSES
+            if was_busy and not is_busy:
+                self._vm_busy[task_info.vm_name] = max(self._vm_busy[task_info.vm_name] - 1, 0)
+            elif is_busy and not was_busy:
+                self._vm_busy[task_info.vm_name] += 1
+        
+        if current_status == "completed":
+            # VM is now free! Analysis finished, CAPE is generating JSON report
+            # We can submit new samples to this VM, but keep tracking this task
+            if changed:
+                logger.info(f"🟢 VM {task_info.vm_name} freed! Task {task_id} completed analysis, generating report: {task_info.sample_path.name}")
+            # Don't remove from active_tasks yet, keep monitoring until "reported"
+        
+        elif current_status in ["reported", "failed_analysis", "failed_processing", "failed_reporting"]:
+            if current_status == "reported":
+                task_info.completion_time = time.time()
+            self._finalizing.add(task_id)
+            self._reports_seen.discard(task_id)
+            return changed, True
+        
+        return changed, False
+
+    def monitor_tasks(self) -> bool:
+        """Monitor active tasks and update their status.
+        
+        Returns True if any task changed status during this tick.
+        """
+        # One /tasks/list/ call per tick covers every active task
+        all_tasks = self._poll_all()
+        if all_tasks is None:
+            return False
+        
+        self.vm_status = self._compute_vm_status(all_tasks.values())
+        # Fresh payload: let the submit drain reuse it instead of re-polling
+        self._vm_status_cache = (time.monotonic(), self.vm_status)
+        
+        # Work out transitions against a snapshot, without holding the lock
+        transitions = []
+        for task_id, task_info in dict(self.active_tasks).items():
+            task = all_tasks.get(task_id)
+            if task is not None:
+                current_status = task.get('status', 'unknown')
+            else:
+                # Not in the listing (capped window, other users' tasks): ask for it directly
                 current_status = self.get_task_status(task_id)
-                
                 if current_status is None:
                     continue
+            if current_status != task_info.status:
+                transitions.append((task_info, current_status))
+        
+        changed = False
+        to_finalize = []
+        with self._mutate:
+            for task_info, current_status in transitions:
+                # Already handed off to the I/O pool (e.g. by the report watcher)
+                if task_info.task_id in self._finalizing:
+                    continue
                 
-                previous_status = task_info.status
-                task_info.status = current_status
-                
-                if current_status != previous_status:
-                    logger.info(f"Task {task_id} status changed: {previous_status} -> {current_status}")
-                
-                if current_status == "completed":
-                    # VM is now free! Analysis finished, CAPE is generating JSON report
-                    # We can submit new samples to this VM, but keep tracking this task
-                    logger.info(f"🟢 VM {task_info.vm_name} freed! Task {task_id} completed analysis, generating report: {task_info.sample_path.name}")
-                    # Don't remove from active_tasks yet, keep monitoring until "reported"
-                
-                elif current_status == "reported":
-                    # JSON report is ready for retrieval
-                    success = self.retrieve_json_report(task_id, task_info.sample_path.name)
-                    if success:
-                        self.move_processed_sample(task_info.sample_path, task_id)
-                        self.completed_tasks.append(task_info)
-                        logger.info(f"✅ Retrieved and processed task {task_id}: {task_info.sample_path.name}")
-                    else:
-                        self.move_failed_sample(task_info.sample_path, "report_retrieval_failed")
-                        self.failed_tasks.append(task_info)
-                        logger.error(f"✗ Failed to retrieve report for task {task_id}")
-                    
-                    tasks_to_remove.append(task_id)
-                
-                elif current_status in ["failed_analysis", "failed_processing", "failed_reporting"]:
-                    # Task failed
-                    self.move_failed_sample(task_info.sample_path, current_status)
-                    self.failed_tasks.append(task_info)
-                    logger.warning(f"✗ Failed task {task_id}: {task_info.sample_path.name} ({current_status})")
-                    tasks_to_remove.append(task_id)
-            
-            # Remove completed/failed tasks
-            for task_id in tasks_to_remove:
-                del self.active_tasks[task_id]
+                task_changed, finished = self._apply_status(task_info, current_status)
+                changed = changed or task_changed
+                if finished:
+                    to_finalize.append(task_info)
+        
+        # Report copies and sample moves run outside the lock, overlapped across tasks
+        if to_finalize:
+            # One timestamp for the whole batch; file names stay unique via task ID
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            for task_info in to_finalize:
+                self.io_pool.submit(self._finalize_reported, task_info, timestamp)
+        
+        return changed
+
+    def _watch_reports(self):
+        """Wake the main loop as soon as CAPE writes a report.json (inotify via watchfiles)"""
+        def is_report(change, path: str) -> bool:
+            return path.endswith(os.path.join("reports", "report.json"))
+        
+        try:
+            for changes in watchfiles.watch(self.cape_storage, watch_filter=is_report,
+                                            stop_event=self._watch_stop):
+                for _, path in changes:
+                    task_id = Path(path).parent.parent.name
+                    # report.json is created before CAPE marks the task reported; the main
+                    # loop polls at its minimum interval until this task is finalized
+                    with self._mutate:
+                        if task_id not in self.active_tasks or task_id in self._finalizing:
+                            continue
+                        self._reports_seen.add(task_id)
+                    self._wake.set()
+        except Exception as e:
+            logger.warning(f"Report watcher stopped, relying on polling: {e}")
 
-    def submit_next_sample(self, samples_queue: List[Path]) -> bool:
+    def submit_next_sample(self, samples_queue: Deque[Path]) -> bool:
         """Submit next available sample if VM is available"""
         if not samples_queue:
             return False
@@ -337,43 +663,41 @@ class CAPEAutomation:
         if not available_vm:
             return False
         
-        with self.lock:
-            # Double-check we still have samples and VM is available
-            if not samples_queue:
-                return False
-            
-            sample_path = samples_queue.pop(0)
-            task_id = self.submit_sample(sample_path, available_vm)
-            
-            if task_id:
-                # Track the task
-                task_info = TaskInfo(
-                    task_id=task_id,
-                    sample_path=sample_path,
-                    vm_name=available_vm,
-                    submission_time=time.time()
-                )
+        # The queue is only consumed by the main loop, so no lock is needed here
+        sample_path = samples_queue.popleft()
+        task_id = self.submit_sample(sample_path, available_vm)
+        
+        if task_id:
+            # Track the task
+            task_info = TaskInfo(
+                task_id=task_id,
+                sample_path=sample_path,
+                vm_name=available_vm,
+                submission_time=time.time()
+            )
+            with self._mutate:
                 self.active_tasks[task_id] = task_info
-                self.vm_status[available_vm] = "busy"
-                return True
-            else:
-                # Submission failed
-                self.move_failed_sample(sample_path, "submission_failed")
-                return False
+                self._vm_busy[available_vm] += 1
+            self.vm_status[available_vm] = "busy"
+            return True
+        else:
+            # Submission failed
+            self.move_failed_sample(sample_path, "submission_failed")
+            return False
 
     def clear_screen(self):
-        """Clear the terminal screen"""
-        os.system('cls' if os.name == 'nt' else 'clear')
+        """Clear the terminal screen (cursor home + clear to end, no subprocess)"""
+        sys.stdout.write('\x1b[H\x1b[J')
+        sys.stdout.flush()
 
     def print_status(self):
         """Print current processing status (clears screen first to save memory)"""
         # Clear screen to prevent memory buildup from terminal buffer
         self.clear_screen()
         
-        with self.lock:
-            active_count = len(self.active_tasks)
-            completed_count = len(self.completed_tasks)
-            failed_count = len(self.failed_tasks)
+        active_count = len(self.active_tasks)
+        completed_count = self._completed_count
+        failed_count = self._failed_count
         
         vm_status = self.get_vm_status()
         
@@ -396,12 +720,12 @@ class CAPEAutomation:
         
         if active_count > 0:
             print(f"\nActive Tasks:")
-            with self.lock:
-                for task_id, task_info in list(self.active_tasks.items())[:5]:  # Show first 5
-                    duration = int(time.time() - task_info.submission_time)
-                    print(f"  Task {task_id}: {task_info.sample_path.name} on {task_info.vm_name} ({duration}s)")
-                if len(self.active_tasks) > 5:
-                    print(f"  ... and {len(self.active_tasks) - 5} more")
+            active = list(self.active_tasks.items())  # Snapshot, never blocks writers
+            for task_id, task_info in active[:5]:  # Show first 5
+                duration = int(time.time() - task_info.submission_time)
+                print(f"  Task {task_id}: {task_info.sample_path.name} on {task_info.vm_name} ({duration}s)")
+            if len(active) > 5:
+                print(f"  ... and {len(active) - 5} more")
         
         print(f"{'='*60}")
         print("Press Ctrl+C to stop")
@@ -412,10 +736,13 @@ class CAPEAutomation:
         self.setup_output_directories(folder_path.name)
         
         # Reset counters for new folder
-        with self.lock:
+        with self._mutate:
             self.active_tasks.clear()
-            self.completed_tasks.clear()
-            self.failed_tasks.clear()
+            self._completed_count = 0
+            self._failed_count = 0
+            self._finalizing.clear()
+            self._reports_seen.clear()
+            self._vm_busy = {vm: 0 for vm in self.vms}
         
         samples = self.get_samples(folder_path)
         if not samples:
@@ -425,7 +752,7 @@ class CAPEAutomation:
         logger.info(f"Starting to process {len(samples)} samples from {folder_path.name}")
         
         # Create a working queue of samples
-        samples_queue = samples.copy()
+        samples_queue = deque(samples)
         
         # Initial submission burst (fill all available VMs)
         initial_submissions = 0
@@ -437,11 +764,18 @@ class CAPEAutomation:
         
         # Main processing loop
         last_status_print = 0
+        last_transition_ts = time.time()
+        interval = 2.0  # Poll interval in seconds, backs off while nothing changes
         while True:
             current_time = time.time()
             
+            # Tasks finishing after this point will cut the next sleep short
+            self._wake.clear()
+            
             # Monitor active tasks
-            self.monitor_tasks()
+            changed = self.monitor_tasks()
+            if changed:
+                last_transition_ts = current_time
             
             # Try to submit more samples
             submitted = False
@@ -454,16 +788,23 @@ class CAPEAutomation:
                 last_status_print = current_time
             
             # Check if we're done
-            with self.lock:
-                active_count = len(self.active_tasks)
-                remaining_samples = len(samples_queue)
+            active_count = len(self.active_tasks)
+            remaining_samples = len(samples_queue)
             
             if active_count == 0 and remaining_samples == 0:
                 logger.info(f"Completed processing folder {folder_path.name}")
                 break
             
-            # Sleep for a bit before next iteration
-            time.sleep(10)  # Check every 10 seconds
+            # Poll quickly right after activity or while a written report awaits 'reported',
+            # back off while all VMs stay busy
+            if changed or submitted or self._reports_seen:
+                interval = 2.0
+            else:
+                interval = min(interval * 1.5, 30.0)
+                logger.debug(f"No transitions for {int(current_time - last_transition_ts)}s, next poll in {interval:.1f}s")
+            # Sleep until the interval elapses or the loop is woken early
+            if self._wake.wait(interval):
+                interval = 2.0
         
         # Final status
         self.print_folder_summary()
@@ -471,10 +812,9 @@ class CAPEAutomation:
 
     def print_folder_summary(self):
         """Print summary for completed folder"""
-        with self.lock:
-            completed_count = len(self.completed_tasks)
-            failed_count = len(self.failed_tasks)
-            total_count = completed_count + failed_count
+        completed_count = self._completed_count
+        failed_count = self._failed_count
+        total_count = completed_count + failed_count
         
         print(f"\n{'='*60}")
         print(f"FOLDER COMPLETED: {self.current_folder}")
@@ -486,15 +826,14 @@ class CAPEAutomation:
             print(f"Success rate: {(completed_count/total_count)*100:.1f}%")
         
         if completed_count > 0:
-            durations = []
-            with self.lock:
-                for task in self.completed_tasks:
-                    if hasattr(task, 'completion_time'):
-                        duration = task.completion_time - task.submission_time
-                        durations.append(duration)
+            with self._db_lock:
+                avg_duration, timed_count = self.results_db.execute(
+                    "SELECT AVG(complete_ts - submit_ts), COUNT(*) FROM results "
+                    "WHERE run_id = ? AND folder = ? AND status = 'completed' AND complete_ts IS NOT NULL",
+                    (self.run_id, self.current_folder)
+                ).fetchone()
             
-            if durations:
-                avg_duration = sum(durations) / len(durations)
+            if timed_count:
                 print(f"Average processing time: {avg_duration/60:.1f} minutes")
         
         print(f"\nOutput locations:")
@@ -507,20 +846,29 @@ class CAPEAutomation:
         """Main execution loop"""
         logger.info("Starting CAPEv2 Automation")
         
-        folders = self.discover_folders()
-        if not folders:
-            logger.error("No folders found to process")
-            return
-        
-        for folder in folders:
-            samples = self.get_samples(folder)
-            if samples:
-                logger.info(f"Processing folder: {folder.name} ({len(samples)} samples)")
-                self.process_folder(folder)
-            else:
-                logger.info(f"Skipping empty folder: {folder.name}")
+        if watchfiles is not None and self.cape_storage.exists():
+            threading.Thread(target=self._watch_reports, name="report-watcher", daemon=True).start()
         
-        logger.info("CAPEv2 Automation completed")
+        try:
+            folders = self.discover_folders()
+            if not folders:
+                logger.error("No folders found to process")
+                return
+            
+            for folder in folders:
+                samples = self.get_samples(folder)
+                if samples:
+                    logger.info(f"Processing folder: {folder.name} ({len(samples)} samples)")
+                    self.process_folder(folder)
+                else:
+                    logger.info(f"Skipping empty folder: {folder.name}")
+            
+            logger.info("CAPEv2 Automation completed")
+        finally:
+            self._watch_stop.set()
+            self.io_pool.shutdown(wait=True)
+            self.http.close()
+            self.results_db.close()
 
 def main():
     # Example usage - process only Downloader folders